@@ -1,257 +1,269 @@
 import collections
-import dataclasses
-import json
+import datetime
 import pathlib
 import uuid
 
-from babel.messages.catalog import Catalog
-from babel.messages.pofile import write_po
+from babel.messages.catalog import Message
 
 import dsw.models.knowledge_model.flat as km_flat
 
 ROOT = pathlib.Path(__file__).parent
 
-
-@dataclasses.dataclass
-class ExtractedMessage:
-    msgid: str
-    entity_type: str
-    entity_uuid: uuid.UUID
-    entity_attribute: str
-
-    @property
-    def path(self) -> str:
-        return f'{self.entity_type}:{self.entity_uuid}:{self.entity_attribute}'
-
-    @property
-    def line(self) -> int:
-        return 0
+POT_HEADER = """\
+# Translations template for {project}.
+# Copyright (C) {year} ORGANIZATION
+# This file is distributed under the same license as the {project} project.
+# FIRST AUTHOR <EMAIL@ADDRESS>, {year}.
+#
+#, fuzzy
+msgid ""
+msgstr ""
+"Project-Id-Version: {project} {version}\\n"
+"Report-Msgid-Bugs-To: EMAIL@ADDRESS\\n"
+"POT-Creation-Date: {creation_date}\\n"
+"PO-Revision-Date: YEAR-MO-DA HO:MI+ZONE\\n"
+"Last-Translator: FULL NAME <EMAIL@ADDRESS>\\n"
+"Language-Team: LANGUAGE <LL@li.org>\\n"
+"MIME-Version: 1.0\\n"
+"Content-Type: text/plain; charset=utf-8\\n"
+"Content-Transfer-Encoding: 8bit\\n"
+
+"""
 
 
 class MessageExtractor:
 
     def __init__(self, km: km_flat.KnowledgeModel):
         self.km = km
-        self.messages = []
+        self.locs_by_msgid: dict[str, list[str]] = collections.defaultdict(list)
+        # Single UUID index over all entities reachable from chapters, so that
+        # child entities are resolved by one lookup regardless of their type
+        entities = km.entities
+        indexed = (
+            entities.chapters,
+            entities.questions,
+            entities.answers,
+            entities.choices,
+            entities.references,
+        )
+        self._entities: dict[uuid.UUID, object] = {}
+        for collection in indexed:
+            self._entities.update(collection)
+        if len(self._entities) != sum(len(collection) for collection in indexed):
+            raise ValueError('Entity UUIDs are not unique across the knowledge model')
 
     def reset(self):
-        self.messages.clear()
-
-    def _extract_messages_answer(self, answer: km_flat.Answer):
-        self.messages.append(ExtractedMessage(
-            msgid=answer.label,
-            entity_type='answer',
-            entity_uuid=answer.uuid,
-            entity_attribute='label',
-        ))
+        self.locs_by_msgid.clear()
+
+    def _extract_messages_answer(self, answer: km_flat.Answer, stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'answer:' + str(answer.uuid)
+        if answer.label:
+            locs_by_msgid[answer.label].append(prefix + ':label')
         if answer.advice:
-            self.messages.append(ExtractedMessage(
-                msgid=answer.advice,
-                entity_type='answer',
-                entity_uuid=answer.uuid,
-                entity_attribute='advice',
-            ))
-
-        for question_uuid in answer.follow_up_uuids:
-            question = self.km.entities.questions.get(question_uuid)
-            self._extract_messages_question(question)
-
-    def _extract_messages_choice(self, choice: km_flat.Choice):
-        self.messages.append(ExtractedMessage(
-            msgid=choice.label,
-            entity_type='choice',
-            entity_uuid=choice.uuid,
-            entity_attribute='label',
-        ))
-
-    def _extract_messages_question(self, question: km_flat.Question):
-        self.messages.append(ExtractedMessage(
-            msgid=question.title,
-            entity_type='question',
-            entity_uuid=question.uuid,
-            entity_attribute='title',
-        ))
+            locs_by_msgid[answer.advice].append(prefix + ':advice')
+
+        stack.extend(reversed(answer.follow_up_uuids))
+
+    def _extract_messages_choice(self, choice: km_flat.Choice, stack: collections.deque):
+        if choice.label:
+            self.locs_by_msgid[choice.label].append(f'choice:{choice.uuid}:label')
+
+    def _extract_messages_question(self, question: km_flat.Question,
+                                   stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'question:' + str(question.uuid)
+        if question.title:
+            locs_by_msgid[question.title].append(prefix + ':title')
         if question.text:
-            self.messages.append(ExtractedMessage(
-                msgid=question.text,
-                entity_type='question',
-                entity_uuid=question.uuid,
-                entity_attribute='text',
-            ))
-
-        if isinstance(question, km_flat.ListQuestion):
-            for question_uuid in question.item_template_question_uuids:
-                item_question = self.km.entities.questions.get(question_uuid)
-                self._extract_messages_question(item_question)
-        if isinstance(question, km_flat.MultiChoiceQuestion):
-            for choice_uuid in question.choice_uuids:
-                choice = self.km.entities.choices.get(choice_uuid)
-                self._extract_messages_choice(choice)
-        if isinstance(question, km_flat.OptionsQuestion):
-            for answer_uuid in question.answer_uuids:
-                answer = self.km.entities.answers.get(answer_uuid)
-                self._extract_messages_answer(answer)
-
-        for reference_uuid in question.reference_uuids:
-            reference = self.km.entities.references.get(reference_uuid)
-            self._extract_messages_reference(reference)
-
-    def _extract_messages_reference(self, reference: km_flat.Reference):
-        if isinstance(reference, km_flat.URLReference):
-            self.messages.append(ExtractedMessage(
-                msgid=reference.label,
-                entity_type='url-reference',
-                entity_uuid=reference.uuid,
-                entity_attribute='label',
-            ))
-        if isinstance(reference, km_flat.CrossReference):
-            self.messages.append(ExtractedMessage(
-                msgid=reference.description,
-                entity_type='cross-reference',
-                entity_uuid=reference.uuid,
-                entity_attribute='description',
-            ))
-
-    def _extract_messages_chapter(self, chapter: km_flat.Chapter):
-        self.messages.append(ExtractedMessage(
-            msgid=chapter.title,
-            entity_type='chapter',
-            entity_uuid=chapter.uuid,
-            entity_attribute='title',
-        ))
+            locs_by_msgid[question.text].append(prefix + ':text')
+
+        stack.extend(reversed(question.reference_uuids))
+
+    def _extract_messages_list_question(self, question: km_flat.ListQuestion,
+                                        stack: collections.deque):
+        self._extract_messages_question(question, stack)
+        stack.extend(reversed(question.item_template_question_uuids))
+
+    def _extract_messages_multi_choice_question(self, question: km_flat.MultiChoiceQuestion,
+                                                stack: collections.deque):
+        self._extract_messages_question(question, stack)
+        stack.extend(reversed(question.choice_uuids))
+
+    def _extract_messages_options_question(self, question: km_flat.OptionsQuestion,
+                                           stack: collections.deque):
+        self._extract_messages_question(question, stack)
+        stack.extend(reversed(question.answer_uuids))
+
+    def _extract_messages_url_reference(self, reference: km_flat.URLReference,
+                                        stack: collections.deque):
+        if reference.label:
+            self.locs_by_msgid[reference.label].append(
+                f'url-reference:{reference.uuid}:label',
+            )
+
+    def _extract_messages_cross_reference(self, reference: km_flat.CrossReference,
+                                          stack: collections.deque):
+        if reference.description:
+            self.locs_by_msgid[reference.description].append(
+                f'cross-reference:{reference.uuid}:description',
+            )
+
+    def _extract_messages_resource_page_reference(
+        self,
+        reference: km_flat.ResourcePageReference,
+        stack: collections.deque,
+    ):
+        # Resource page references have no translatable content
+        pass
+
+    def _extract_messages_chapter(self, chapter: km_flat.Chapter,
+                                  stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'chapter:' + str(chapter.uuid)
+        if chapter.title:
+            locs_by_msgid[chapter.title].append(prefix + ':title')
         if chapter.text:
-            self.messages.append(ExtractedMessage(
-                msgid=chapter.text,
-                entity_type='chapter',
-                entity_uuid=chapter.uuid,
-                entity_attribute='text',
-            ))
-        for question_uuid in chapter.question_uuids:
-            question = self.km.entities.questions.get(question_uuid)
-            self._extract_messages_question(question)
-
-    def _extract_messages_phase(self, phase: km_flat.Phase):
-        self.messages.append(ExtractedMessage(
-            msgid=phase.title,
-            entity_type='phase',
-            entity_uuid=phase.uuid,
-            entity_attribute='title',
-        ))
+            locs_by_msgid[chapter.text].append(prefix + ':text')
+
+        stack.extend(reversed(chapter.question_uuids))
+
+    def _extract_messages_phase(self, phase: km_flat.Phase, stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'phase:' + str(phase.uuid)
+        if phase.title:
+            locs_by_msgid[phase.title].append(prefix + ':title')
         if phase.description:
-            self.messages.append(ExtractedMessage(
-                msgid=phase.description,
-                entity_type='phase',
-                entity_uuid=phase.uuid,
-                entity_attribute='description',
-            ))
-
-    def _extract_messages_tag(self, tag: km_flat.Tag):
-        self.messages.append(ExtractedMessage(
-            msgid=tag.name,
-            entity_type='tag',
-            entity_uuid=tag.uuid,
-            entity_attribute='name',
-        ))
+            locs_by_msgid[phase.description].append(prefix + ':description')
+
+    def _extract_messages_tag(self, tag: km_flat.Tag, stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'tag:' + str(tag.uuid)
+        if tag.name:
+            locs_by_msgid[tag.name].append(prefix + ':name')
         if tag.description:
-            self.messages.append(ExtractedMessage(
-                msgid=tag.description,
-                entity_type='tag',
-                entity_uuid=tag.uuid,
-                entity_attribute='description',
-            ))
-
-    def _extract_messages_metric(self, metric: km_flat.Metric):
-        self.messages.append(ExtractedMessage(
-            msgid=metric.title,
-            entity_type='metrics',
-            entity_uuid=metric.uuid,
-            entity_attribute='title',
-        ))
+            locs_by_msgid[tag.description].append(prefix + ':description')
+
+    def _extract_messages_metric(self, metric: km_flat.Metric, stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'metrics:' + str(metric.uuid)
+        if metric.title:
+            locs_by_msgid[metric.title].append(prefix + ':title')
         if metric.description:
-            self.messages.append(ExtractedMessage(
-                msgid=metric.description,
-                entity_type='metrics',
-                entity_uuid=metric.uuid,
-                entity_attribute='description',
-            ))
-
-    def _extract_messages_resource_collection(self, rc: km_flat.ResourceCollection):
-        self.messages.append(ExtractedMessage(
-            msgid=rc.title,
-            entity_type='resource_collection',
-            entity_uuid=rc.uuid,
-            entity_attribute='title',
-        ))
-
-        for rp_uuid in rc.resource_page_uuids:
-            rp = self.km.entities.resource_pages.get(rp_uuid)
-            self._extract_messages_resource_page(rp)
-
-    def _extract_messages_resource_page(self, rp: km_flat.ResourcePage):
-        self.messages.append(ExtractedMessage(
-            msgid=rp.title,
-            entity_type='resource_page',
-            entity_uuid=rp.uuid,
-            entity_attribute='title',
-        ))
+            locs_by_msgid[metric.description].append(
+                prefix + ':description',
+            )
+
+    def _extract_messages_resource_collection(self, rc: km_flat.ResourceCollection,
+                                              stack: collections.deque):
+        if rc.title:
+            self.locs_by_msgid[rc.title].append(f'resource_collection:{rc.uuid}:title')
+
+        stack.extend(reversed(rc.resource_page_uuids))
+
+    def _extract_messages_resource_page(self, rp: km_flat.ResourcePage,
+                                        stack: collections.deque):
+        locs_by_msgid = self.locs_by_msgid
+        prefix = 'resource_page:' + str(rp.uuid)
+        if rp.title:
+            locs_by_msgid[rp.title].append(prefix + ':title')
         if rp.content:
-            self.messages.append(ExtractedMessage(
-                msgid=rp.content,
-                entity_type='resource_page',
-                entity_uuid=rp.uuid,
-                entity_attribute='content',
-            ))
-
-    def extract_messages(self) -> list[ExtractedMessage]:
+            locs_by_msgid[rp.content].append(prefix + ':content')
+
+    def extract_messages(self) -> dict[str, list[str]]:
         self.reset()
-        for chapter_uuid in self.km.chapter_uuids:
-            chapter = self.km.entities.chapters.get(chapter_uuid)
-            self._extract_messages_chapter(chapter)
-        return self.messages
+        stack = collections.deque(reversed(self.km.chapter_uuids))
+        pop = stack.pop
+        get_entity = self._entities.get
+        get_handler = _HANDLERS.get
+        # Entities reachable from several parents (or via a cycle) are
+        # walked only once
+        visited = set()
+        while stack:
+            entity_uuid = pop()
+            if entity_uuid in visited:
+                continue
+            visited.add(entity_uuid)
+            entity = get_entity(entity_uuid)
+            handler = get_handler(type(entity))
+            if handler is None:
+                if entity is None:
+                    raise ValueError(f'Entity {entity_uuid} not found '
+                                     'in the knowledge model')
+                raise TypeError(f'No message handler for {type(entity).__name__} '
+                                f'(entity {entity_uuid})')
+            handler(self, entity, stack)
+        return self.locs_by_msgid
+
+
+# Entity type -> MessageExtractor handler; each handler collects messages of
+# the entity and pushes UUIDs of its child entities onto the work stack
+_HANDLERS = {
+    km_flat.Chapter: MessageExtractor._extract_messages_chapter,
+    km_flat.OptionsQuestion: MessageExtractor._extract_messages_options_question,
+    km_flat.MultiChoiceQuestion: MessageExtractor._extract_messages_multi_choice_question,
+    km_flat.ListQuestion: MessageExtractor._extract_messages_list_question,
+    km_flat.ValueQuestion: MessageExtractor._extract_messages_question,
+    km_flat.IntegrationQuestion: MessageExtractor._extract_messages_question,
+    km_flat.ItemSelectQuestion: MessageExtractor._extract_messages_question,
+    km_flat.FileQuestion: MessageExtractor._extract_messages_question,
+    km_flat.Answer: MessageExtractor._extract_messages_answer,
+    km_flat.Choice: MessageExtractor._extract_messages_choice,
+    km_flat.URLReference: MessageExtractor._extract_messages_url_reference,
+    km_flat.CrossReference: MessageExtractor._extract_messages_cross_reference,
+    km_flat.ResourcePageReference: MessageExtractor._extract_messages_resource_page_reference,
+}
+
+
+def _escape(text: str) -> str:
+    escaped = (
+        text.replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\r', '\\r')
+        .replace('\n', '\\n')
+        .replace('"', '\\"')
+    )
+    return f'"{escaped}"'
+
+
+def _normalize(text: str) -> str:
+    # Multi-line strings start with "" followed by one quoted line per line
+    # (same as gettext/Babel output without line wrapping)
+    lines = text.splitlines(True)
+    if len(lines) <= 1:
+        return _escape(text)
+    return '""\n' + '\n'.join(_escape(line) for line in lines)
 
 
 def build_pot(
-    messages: list[ExtractedMessage],
+    locs_by_msgid: dict[str, list[str]],
     out_path: str | pathlib.Path,
 ) -> None:
-    catalog = Catalog(
+    now = datetime.datetime.now().astimezone()
+    parts = [POT_HEADER.format(
         project='Common DSW Knowledge Model',
         version='2.7.0',
-        charset='utf-8',
-    )
-    # 1) Group locations by msgid
-    locs_by_msgid: dict[str, set[tuple[str, int]]] = collections.defaultdict(set)
-    for occ in messages:
-        if not occ.msgid:
-            continue
-        locs_by_msgid[occ.msgid].add((occ.path, int(occ.line)))
-
-    for msgid, locs in sorted(locs_by_msgid.items(), key=lambda kv: kv[0]):
-        # Sort locations for stable output (nice diffs)
-        locations = sorted(locs, key=lambda t: (t[0], t[1]))
-
-        catalog.add(
-            msgid,
-            locations=locations,
-            # IMPORTANT: do not set `context=` if you want one entry per msgid
-        )
+        year=now.strftime('%Y'),
+        creation_date=now.strftime('%Y-%m-%d %H:%M%z'),
+    )]
+    for msgid in sorted(locs_by_msgid):
+        # Sort locations for stable output (nice diffs); each entity is walked
+        # once, so paths are already unique
+        for path in sorted(locs_by_msgid[msgid]):
+            parts.append(f'#: {path}\n')
+        # Format flags (python-format, ...) as Babel detects them
+        flags = sorted(Message(msgid).flags)
+        if flags:
+            parts.append(f'#, {", ".join(flags)}\n')
+        parts.append(f'msgid {_normalize(msgid)}\nmsgstr ""\n\n')
 
-    # 3) Write .pot
     out_path = pathlib.Path(out_path)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("wb") as f:
-        write_po(
-            f,
-            catalog,
-            sort_output=True,
-            width=-1,
-        )
-
+    out_path.write_bytes(''.join(parts).encode('utf-8', 'backslashreplace'))
 
 if __name__ == '__main__':
     input_file = ROOT / 'km.json'
     output_file = ROOT / 'messages.pot'
-    data = json.loads(input_file.read_text(encoding='utf-8'))
-    km = km_flat.KnowledgeModel.model_validate(data)
-    messages = MessageExtractor(km).extract_messages()
-    build_pot(messages, output_file)
+    km = km_flat.KnowledgeModel.model_validate_json(input_file.read_bytes())
+    locs_by_msgid = MessageExtractor(km).extract_messages()
+    build_pot(locs_by_msgid, output_file)